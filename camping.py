@@ -3,15 +3,19 @@
 import argparse
 import json
 import logging
+import random
 import sys
+import threading
 import time
-from datetime import date, datetime, timedelta
-from dateutil import rrule
-from itertools import count, groupby
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
 
+import orjson
 import requests
-from fake_useragent import UserAgent
-ua = UserAgent(verify_ssl=False)
+from requests.adapters import HTTPAdapter
 
 LOG = logging.getLogger(__name__)
 formatter = logging.Formatter("%(asctime)s - %(process)s - %(levelname)s - %(message)s")
@@ -26,11 +30,103 @@ MAIN_PAGE_ENDPOINT = "/api/camps/campgrounds/"
 INPUT_DATE_FORMAT = "%Y-%m-%d"
 ISO_DATE_FORMAT_REQUEST = "%Y-%m-%dT00:00:00.000Z"
 ISO_DATE_FORMAT_RESPONSE = "%Y-%m-%dT00:00:00Z"
+# What ISO_DATE_FORMAT_RESPONSE adds after the date, for building those strings
+# from date.isoformat() without going through strftime.
+_RESPONSE_TIME_SUFFIX = ISO_DATE_FORMAT_RESPONSE[len("%Y-%m-%d"):]
+
+# Upper bound on concurrent requests in flight at once.
+MAX_WORKERS = 16
+
+# Sustained requests per second sent to recreation.gov, and how many may go out
+# back to back before that kicks in. Shared by every check in the process.
+DEFAULT_REQUESTS_PER_SECOND = 2.0
+REQUEST_BURST = 5
+
+# Polling backoff, in seconds. After each poll that finds nothing the wait is
+# drawn uniformly from [0, min(MAX, MIN * 2 ** attempt)] ("full jitter"), so
+# many checkers don't end up hitting the API in lockstep.
+MIN_POLL_INTERVAL = 30
+MAX_POLL_INTERVAL = 600
+
+# Wait before retrying after the n-th consecutive failed poll, +/- 50% jitter.
+ERROR_BACKOFF_LADDER = (1, 2, 4, 8, 16, 30)
+
+# How long a month of availability data is reused before asking again. This is
+# kept below MIN_POLL_INTERVAL so polls rarely see stale data, it mostly saves
+# requests when several checks are watching the same park.
+AVAILABILITY_CACHE_TTL = 25
+
+# {(park_id, month ISO string): (time.monotonic() when fetched, response)}
+_availability_cache = {}
+
+# Validators of the last successful response for each request, so unchanged
+# data comes back as an empty 304 instead of being downloaded and parsed again.
+# {(url, sorted params): (ETag, Last-Modified, parsed response)}
+_etag_cache = {}
+
+# A few common browser User-Agents, one is picked per session. This used to
+# come from fake_useragent, which downloads its database on import.
+USER_AGENTS = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 Edg/120.0.0.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Safari/605.1.15",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:121.0) Gecko/20100101 Firefox/121.0",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:121.0) Gecko/20100101 Firefox/121.0",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_2 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Mobile/15E148 Safari/604.1",
+)
+
+# Availability value of a bookable night.
+AVAILABLE = "Available"
 
 SUCCESS_EMOJI = "🏕"
 FAILURE_EMOJI = "❌"
 
-headers = {"User-Agent": ua.random}
+class TokenBucket:
+    """
+    A thread-safe token bucket. `acquire` blocks just long enough to keep
+    callers at `rate` calls per second on average, while letting up to
+    `burst` calls through immediately after a quiet period.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Take the token right away, even if that puts the bucket in debt,
+            # so concurrent callers queue up behind each other in order.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+RATE_LIMITER = TokenBucket(DEFAULT_REQUESTS_PER_SECOND, REQUEST_BURST)
+
+# One session for the whole process so connections (and their TLS handshakes)
+# are reused across requests and polls instead of being set up every time.
+_SESSION = requests.Session()
+_SESSION.headers["User-Agent"] = random.choice(USER_AGENTS)
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        # No retries here: they would bypass RATE_LIMITER. 429s and 5xxs raise
+        # TransientRequestError and are retried by the polling backoff instead.
+        max_retries=0,
+    ),
+)
 
 
 def format_date(date_object, format_string=ISO_DATE_FORMAT_REQUEST):
@@ -42,8 +138,62 @@ def format_date(date_object, format_string=ISO_DATE_FORMAT_REQUEST):
     return date_formatted
 
 
+class TransientRequestError(RuntimeError):
+    """
+    Raised for responses that are likely to succeed if retried later, e.g.
+    when being rate limited or when the server is having trouble.
+
+    `retry_after` is the number of seconds the server asked us to wait, if any.
+    """
+
+    def __init__(self, *args, retry_after=None):
+        super().__init__(*args)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """
+    Parses a Retry-After header, which is either a number of seconds or an
+    HTTP date, into a number of seconds. Returns None if it can't be parsed.
+    """
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
 def send_request(url, params):
-    resp = requests.get(url, params=params, headers=headers)
+    key = (url, tuple(sorted(params.items())))
+    cached = _etag_cache.get(key)
+    headers = {}
+    if cached is not None:
+        etag, last_modified, _ = cached
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    RATE_LIMITER.acquire()
+    resp = _SESSION.get(url, params=params, headers=headers, timeout=10)
+    if resp.status_code == 304 and cached is not None:
+        return cached[2]
+    if resp.status_code == 429 or resp.status_code >= 500:
+        raise TransientRequestError(
+            "failedRequest",
+            "ERROR, {} code received from {}: {}".format(
+                resp.status_code, url, resp.text
+            ),
+            retry_after=parse_retry_after(resp.headers.get("Retry-After")),
+        )
     if resp.status_code != 200:
         raise RuntimeError(
             "failedRequest",
@@ -51,7 +201,29 @@ def send_request(url, params):
                 resp.status_code, url, resp.text
             ),
         )
-    return resp.json()
+    data = orjson.loads(resp.content)
+
+    etag = resp.headers.get("ETag")
+    last_modified = resp.headers.get("Last-Modified")
+    if etag or last_modified:
+        _etag_cache[key] = (etag, last_modified, data)
+    return data
+
+
+def month_firsts(start_date, end_date):
+    """
+    Returns the first of each month from the month of `start_date` up to and
+    including the month of `end_date`.
+    """
+    year, month = start_date.year, start_date.month
+    months = []
+    while (year, month) <= (end_date.year, end_date.month):
+        months.append(datetime(year, month, 1))
+        month += 1
+        if month == 13:
+            month = 1
+            year += 1
+    return months
 
 
 def get_park_information(park_id, start_date, end_date, campsite_type=None):
@@ -78,62 +250,108 @@ def get_park_information(park_id, start_date, end_date, campsite_type=None):
     """
 
     # Get each first of the month for months in the range we care about.
-    start_of_month = datetime(start_date.year, start_date.month, 1)
-    months = list(rrule.rrule(rrule.MONTHLY, dtstart=start_of_month, until=end_date))
-
-    # Get data for each month.
-    api_data = []
-    for month_date in months:
-        params = {"start_date": format_date(month_date)}
-        LOG.debug("Querying for {} with these params: {}".format(park_id, params))
-        url = "{}{}{}/month?".format(BASE_URL, AVAILABILITY_ENDPOINT, park_id)
-        resp = send_request(url, params)
-        api_data.append(resp)
+    months = month_firsts(start_date, end_date)
+
+    # Get data for each month. The requests are independent of each other, so
+    # they're sent concurrently rather than one after the other.
+    with ThreadPoolExecutor(max_workers=max(1, min(len(months), MAX_WORKERS))) as executor:
+        api_data = list(executor.map(get_month_data, [park_id] * len(months), months))
 
     # Collapse the data into the described output format.
     # Filter by campsite_type if necessary.
-    data = {}
+    data = defaultdict(list)
     for month_data in api_data:
         for campsite_id, campsite_data in month_data["campsites"].items():
-            available = []
-            for date, availability_value in campsite_data["availabilities"].items():
-                if availability_value != "Available":
-                    continue
-                if campsite_type and campsite_type != campsite_data["campsite_type"]:
-                    continue
-                available.append(date)
+            if campsite_type and campsite_type != campsite_data["campsite_type"]:
+                continue
+            available = [
+                date
+                for date, availability_value in campsite_data["availabilities"].items()
+                if availability_value == AVAILABLE
+            ]
             if available:
-                a = data.setdefault(campsite_id, [])
-                a += available
+                data[campsite_id].extend(available)
 
-    return data
+    return dict(data)
 
 
+def get_month_data(park_id, month_date):
+    """
+    Returns the availability response for the month starting at `month_date`,
+    reusing a previous response if it's younger than AVAILABILITY_CACHE_TTL.
+
+    Months that are entirely in the past can't change anymore, so those are
+    kept for as long as the process lives.
+    """
+    params = {"start_date": format_date(month_date)}
+    key = (park_id, params["start_date"])
+    cached = _availability_cache.get(key)
+    if cached is not None:
+        fetched_at, resp = cached
+        today = date.today()
+        if (month_date.year, month_date.month) < (today.year, today.month):
+            return resp
+        if time.monotonic() - fetched_at < AVAILABILITY_CACHE_TTL:
+            return resp
+
+    LOG.debug("Querying for {} with these params: {}".format(park_id, params))
+    url = "{}{}{}/month?".format(BASE_URL, AVAILABILITY_ENDPOINT, park_id)
+    resp = send_request(url, params)
+    _availability_cache[key] = (time.monotonic(), resp)
+    return resp
+
+
+# The name of a campground never changes, so it's only ever looked up once.
+@lru_cache(maxsize=None)
 def get_name_of_site(park_id):
     url = "{}{}{}".format(BASE_URL, MAIN_PAGE_ENDPOINT, park_id)
     resp = send_request(url, {})
     return resp["campground"]["facility_name"]
 
 
-def get_num_available_sites(park_information, start_date, end_date, nights=None):
+# The nights being checked for. `date_to_ordinal` maps the date strings the API
+# returns to ordinals, so the dates never have to be parsed. Anything not in it
+# is outside the desired range.
+_Window = namedtuple("_Window", ["date_to_ordinal", "num_days"])
+
+
+def _make_window(start_date, end_date):
+    # Every night from start_date up to, but not including, end_date.
+    start_ordinal, end_ordinal = start_date.toordinal(), end_date.toordinal()
+    date_to_ordinal = {
+        date.fromordinal(ordinal).isoformat() + _RESPONSE_TIME_SUFFIX: ordinal
+        for ordinal in range(start_ordinal, end_ordinal)
+    }
+    return _Window(date_to_ordinal, end_ordinal - start_ordinal)
+
+
+def get_num_available_sites(
+    park_information, start_date, end_date, nights=None, window=None
+):
+    """
+    Returns how many sites in `park_information` have `nights` consecutive
+    nights available between `start_date` and `end_date`, and how many sites
+    there are in total.
+
+    `window` can be passed in to avoid recomputing it for the same dates on
+    every poll.
+    """
     maximum = len(park_information)
 
     num_available = 0
-    num_days = (end_date - start_date).days
-    dates = [end_date - timedelta(days=i) for i in range(1, num_days + 1)]
-    dates = set(format_date(i, format_string=ISO_DATE_FORMAT_RESPONSE) for i in dates)
+    if window is None:
+        window = _make_window(start_date, end_date)
+    date_to_ordinal, num_days = window
 
     if nights not in range(1, num_days + 1):
         nights = num_days
         LOG.debug('Setting number of nights to {}.'.format(nights))
 
     for site, availabilities in park_information.items():
-        # List of dates that are in the desired range for this site.
-        desired_available = []
-        for date in availabilities:
-            if date not in dates:
-                continue
-            desired_available.append(date)
+        # Ordinals of the dates that are in the desired range for this site.
+        desired_available = [
+            date_to_ordinal[date] for date in availabilities if date in date_to_ordinal
+        ]
         if desired_available and consecutive_nights(desired_available, nights):
             num_available += 1
             LOG.debug("Available site {}: {}".format(num_available, site))
@@ -143,26 +361,54 @@ def get_num_available_sites(park_information, start_date, end_date, nights=None)
 
 def consecutive_nights(available, nights):
     """
-    Returns whether there are `nights` worth of consecutive nights.
+    Returns whether there are `nights` worth of consecutive nights in
+    `available`, a collection of date ordinals (see `date.toordinal`).
     """
-    ordinal_dates = [datetime.strptime(dstr, ISO_DATE_FORMAT_RESPONSE).toordinal() for dstr in available]
-    c = count()
-    longest_consecutive = max((list(g) for _, g in groupby(ordinal_dates, lambda x: x-next(c))), key=len)
-    return len(longest_consecutive) >= nights
+    ordinal_dates = sorted(available)
+    # Single pass over the sorted dates, counting the length of the current
+    # run and stopping as soon as one is long enough.
+    run = 0
+    previous = None
+    for ordinal in ordinal_dates:
+        if previous is not None and ordinal == previous + 1:
+            run += 1
+        else:
+            run = 1
+        if run >= nights:
+            return True
+        previous = ordinal
+    return False
 
 
-def get_availabilities(start_date, end_date, parks, campsite_type=None, nights=None):
+def get_availabilities(start_date, end_date, parks, campsite_type=None, nights=None, window=None):
     out = []
     availabilities = False
-    for park_id in parks:
-        park_information = get_park_information(park_id, start_date, end_date, campsite_type)
+    if window is None:
+        window = _make_window(start_date, end_date)
+
+    # Fetch everything for every park up front and concurrently, the rest of
+    # the loop then only has to wait on the results in order.
+    with ThreadPoolExecutor(max_workers=max(1, min(2 * len(parks), MAX_WORKERS))) as executor:
+        park_futures = [
+            (
+                park_id,
+                executor.submit(get_park_information, park_id, start_date, end_date, campsite_type),
+                executor.submit(get_name_of_site, park_id),
+            )
+            for park_id in parks
+        ]
+
+    for park_id, park_future, name_future in park_futures:
+        park_information = park_future.result()
         LOG.debug(
             "Information for park {}: {}".format(
                 park_id, json.dumps(park_information, indent=2)
             )
         )
-        name_of_site = get_name_of_site(park_id)
-        current, maximum = get_num_available_sites(park_information, start_date, end_date, nights)
+        name_of_site = name_future.result()
+        current, maximum = get_num_available_sites(
+            park_information, start_date, end_date, nights, window=window
+        )
         if current:
             emoji = SUCCESS_EMOJI
             availabilities = True
@@ -186,24 +432,74 @@ def get_availabilities(start_date, end_date, parks, campsite_type=None, nights=N
     return False
 
 
-def execute_check_every_min(start_date, end_date, parks, campsite_type=None, nights=None):
+def poll_delay(attempt, min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL):
+    """
+    Returns how long to wait after the `attempt`-th poll in a row that found
+    nothing, using exponential backoff with full jitter.
+    """
+    return random.uniform(0, min(max_interval, min_interval * 2 ** attempt))
+
+
+def error_delay(errors):
+    """
+    Returns how long to wait after the `errors`-th failed poll in a row.
+    """
+    step = ERROR_BACKOFF_LADDER[min(errors, len(ERROR_BACKOFF_LADDER) - 1)]
+    return step * random.uniform(0.5, 1.5)
+
+
+def execute_check_every_min(
+    start_date,
+    end_date,
+    parks,
+    campsite_type=None,
+    nights=None,
+    min_interval=MIN_POLL_INTERVAL,
+    max_interval=MAX_POLL_INTERVAL,
+    stop_event=None,
+):
+    """
+    Checks for availabilities until some are found and returns the message
+    describing them. If `stop_event` (a `threading.Event`) is given, setting
+    it stops the check between polls, in which case this returns False.
+    """
     LOG.setLevel(logging.INFO)
-    LOG.info("Start checking availabilities every minute with start_date: "
+    LOG.info("Start checking availabilities with start_date: "
         + str(start_date)
         + " end_date: " + str(end_date)
         + " parks: " + str(parks)
         + " campsite_type: " + str(campsite_type)
-        + " nights: " + str(nights))
+        + " nights: " + str(nights)
+        + ". Checks are a random 0-" + str(min_interval) + "s apart at first,"
+        + " backing off to up to " + str(max_interval) + "s while nothing is found.")
     count = 1
+    attempt = 0
+    errors = 0
+    window = _make_window(start_date, end_date)
     try:
-        availabilities = get_availabilities(start_date, end_date, parks, campsite_type, nights)
-        
-        while not availabilities:
-            time.sleep(60)
-            LOG.info("Total # of tries: " + str(count))
-            availabilities = get_availabilities(start_date, end_date, parks, campsite_type, nights)
+        while True:
+            try:
+                availabilities = get_availabilities(
+                    start_date, end_date, parks, campsite_type, nights, window
+                )
+            except (TransientRequestError, requests.RequestException) as e:
+                LOG.warning("Request failed, retrying", exc_info=True)
+                delay = max(error_delay(errors), getattr(e, "retry_after", None) or 0)
+                errors += 1
+            else:
+                if availabilities:
+                    return availabilities
+                errors = 0
+                delay = poll_delay(attempt, min_interval, max_interval)
+                attempt += 1
+
+            LOG.info("Total # of tries: {}, next try in {:.0f}s".format(count, delay))
+            if stop_event is None:
+                time.sleep(delay)
+            elif stop_event.wait(delay):
+                LOG.info("Checking was cancelled after {} tries".format(count))
+                return False
             count += 1
-        return availabilities
     except Exception:
         print("Something went wrong")
         LOG.exception("Something went wrong")
@@ -18,8 +18,9 @@ bot.
 import logging
 import camping
 import argparse
+import re
+import threading
 from datetime import date, datetime, timedelta
-from dateutil import rrule
 import time
 
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
@@ -31,6 +32,20 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 INPUT_DATE_FORMAT = "%Y-%m-%d"
 logger = logging.getLogger(__name__)
 
+# <start date> <end date> <park id(s)> [campsite type] [nights]
+# Multiple park IDs are separated by commas. A campsite type is made of words
+# (e.g. "STANDARD NONELECTRIC") so it can't be mistaken for a park ID or a
+# number of nights.
+COMMAND_RE = re.compile(
+    r"(\d{4}-\d{2}-\d{2})\s+(\d{4}-\d{2}-\d{2})\s+(\d+(?:\s*,\s*\d+)*)"
+    r"(?:\s+([A-Za-z][A-Za-z ]*?))?(?:\s+(\d+))?"
+)
+USAGE = "Usage: <start date YYYY-MM-DD> <end date YYYY-MM-DD> <park id[,park id...]> [campsite type] [nights]"
+
+# {chat_id: stop event} for the check running for each chat.
+checks = {}
+checks_lock = threading.Lock()
+
 
 # Define a few command handlers. These usually take the two arguments update and
 # context. Error handlers also receive the raised TelegramError object in error.
@@ -45,42 +60,91 @@ def help(update, context):
 
 
 def echo(update, context):
-    arglist = update.message.text.split(" ")
-    campsite_type = None
-    nights = None
-
-    if len(arglist) >= 3:
-        start_date, end_date, parks = arglist[0], arglist[1], arglist[2]
-        if valid_date(start_date):
-            start_date = datetime.strptime(start_date, INPUT_DATE_FORMAT)
-        if valid_date(end_date):
-            end_date = datetime.strptime(end_date, INPUT_DATE_FORMAT)
-        parks = [int(park_id) for park_id in str(parks).split(" ")]
-
-        if len(arglist) == 4:
-            campsite_type = arglist[3]
-        if len(arglist) == 5:
-            campsite_type = arglist[3]
-            nights = arglist[4]
-        update.message.reply_text("Start checking availabilities every minute with " 
+    m = COMMAND_RE.fullmatch(update.message.text.strip())
+    if not m:
+        update.message.reply_text("Invalid checking args. " + USAGE)
+        return
+    start_s, end_s, parks_s, campsite_type, nights_s = m.groups()
+    try:
+        start_date = datetime.strptime(start_s, INPUT_DATE_FORMAT)
+        end_date = datetime.strptime(end_s, INPUT_DATE_FORMAT)
+    except ValueError:
+        update.message.reply_text("Invalid dates. " + USAGE)
+        return
+    if end_date <= start_date:
+        update.message.reply_text("The end date must be after the start date. " + USAGE)
+        return
+    parks = [int(park_id) for park_id in re.findall(r"\d+", parks_s)]
+    if campsite_type:
+        campsite_type = " ".join(campsite_type.split())
+    nights = int(nights_s) if nights_s else None
+    if nights is not None and not 0 < nights <= (end_date - start_date).days:
+        update.message.reply_text("Nights must fit between the start and end date. " + USAGE)
+        return
+
+    chat_id = update.effective_chat.id
+    with checks_lock:
+        if chat_id in checks:
+            update.message.reply_text("Already checking, send /cancel to stop that first.")
+            return
+        # The check runs for as long as it takes to find something, so it gets
+        # its own thread instead of blocking the dispatcher for everyone else.
+        stop_event = threading.Event()
+        thread = threading.Thread(
+            target=run_check,
+            args=(context.bot, chat_id, stop_event, start_date, end_date, parks, campsite_type, nights),
+            daemon=True,
+        )
+        checks[chat_id] = stop_event
+
+    try:
+        update.message.reply_text("Start checking availabilities with "
         + "start_date: " + str(start_date)
         + " end_date: " + str(end_date)
         + " parks: " + str(parks)
         + " campsite_type: " + str(campsite_type)
-        + " nights: " + str(nights))
-
-        avail = camping.execute_check_every_min(start_date, end_date, parks, campsite_type, nights)
-    else:
-        update.message.reply_text("Invalid checking args, use default"
-        + "start_date: " + str(args.start_date)
-        + " end_date: " + str(args.end_date)
-        + " parks: " + str(args.parks)
-        + " campsite_type: " + str(args.campsite_type)
-        + " nights: " + str(args.nights))
-        avail = camping.execute_check_every_min(args.start_date, args.end_date, args.parks, args.campsite_type, args.nights)
-    if avail:
-        update.message.reply_text(avail)
-    
+        + " nights: " + str(nights)
+        + ". Checks are a random 0-" + str(args.min_interval) + "s apart at first,"
+        + " backing off to up to " + str(args.max_interval) + "s while nothing is found.")
+    except Exception:
+        # Don't leave the chat stuck "already checking" on a thread that never ran.
+        with checks_lock:
+            if checks.get(chat_id) is stop_event:
+                del checks[chat_id]
+        raise
+    thread.start()
+
+
+def run_check(bot, chat_id, stop_event, start_date, end_date, parks, campsite_type, nights):
+    """Run a check in the background and message the chat with the result."""
+    try:
+        avail = camping.execute_check_every_min(
+            start_date, end_date, parks, campsite_type, nights,
+            args.min_interval, args.max_interval, stop_event
+        )
+    except Exception:
+        logger.exception("Checking for chat %s failed", chat_id)
+        if not stop_event.is_set():
+            bot.send_message(chat_id, "Something went wrong, stopped checking.")
+        return
+    finally:
+        with checks_lock:
+            if checks.get(chat_id) is stop_event:
+                del checks[chat_id]
+    # /cancel may have come in while the last poll was still running.
+    if avail and not stop_event.is_set():
+        bot.send_message(chat_id, avail)
+
+
+def cancel(update, context):
+    """Stop the check running for this chat when the command /cancel is issued."""
+    with checks_lock:
+        stop_event = checks.pop(update.effective_chat.id, None)
+    if stop_event is None:
+        update.message.reply_text("Nothing to cancel.")
+        return
+    stop_event.set()
+    update.message.reply_text("Stopped checking.")
 
 
 def error(update, context):
@@ -101,6 +165,7 @@ def main():
     # on different commands - answer in Telegram
     dp.add_handler(CommandHandler("start", start))
     dp.add_handler(CommandHandler("help", help))
+    dp.add_handler(CommandHandler("cancel", cancel))
 
     # on noncommand i.e message - echo the message on Telegram
     dp.add_handler(MessageHandler(Filters.text, echo))
@@ -116,58 +181,43 @@ def main():
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
 
-def valid_date(s):
-    try:
-        return datetime.strptime(s, INPUT_DATE_FORMAT)
-    except ValueError:
-        msg = "Not a valid date: '{0}'.".format(s)
-        raise argparse.ArgumentTypeError(msg)
-
 def positive_int(i):
     i = int(i)
     if i <= 0:
-        msg = "Not a valid number of nights: {0}".format(i)
+        msg = "Not a valid positive number: {0}".format(i)
         raise argparse.ArgumentTypeError(msg)
     return i
 
+def positive_float(f):
+    f = float(f)
+    if f <= 0:
+        msg = "Not a valid positive number: {0}".format(f)
+        raise argparse.ArgumentTypeError(msg)
+    return f
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", "-d", action="store_true", help="Debug log level")
     parser.add_argument(
-        "--start-date", required=True, help="Start date [YYYY-MM-DD]", type=valid_date
-    )
-    parser.add_argument(
-        "--end-date",
-        required=True,
-        help="End date [YYYY-MM-DD]. You expect to leave this day, not stay the night.",
-        type=valid_date,
+        "--min-interval",
+        default=camping.MIN_POLL_INTERVAL,
+        help=(
+            "Base number of seconds to wait between checks. The wait is randomized "
+            "and doubles after every check that finds nothing (default: %(default)s)."
+        ),
+        type=positive_int,
     )
     parser.add_argument(
-        "--nights",
-        help="Number of consecutive nights (default is all nights in the given range).",
+        "--max-interval",
+        default=camping.MAX_POLL_INTERVAL,
+        help="Maximum number of seconds to wait between checks (default: %(default)s).",
         type=positive_int,
     )
     parser.add_argument(
-        "--campsite-type",
-        help=(
-            'If you want to filter by a type of campsite. For example '
-            '"STANDARD NONELECTRIC" or TODO'
-        ),
-    )
-    parks_group = parser.add_mutually_exclusive_group(required=True)
-    parks_group.add_argument(
-        "--parks",
-        dest="parks",
-        metavar="park",
-        nargs="+",
-        help="Park ID(s)",
-        type=int,
-    )
-    parks_group.add_argument(
-        "--stdin",
-        "-",
-        action="store_true",
-        help="Read list of park ID(s) from stdin instead",
+        "--rps",
+        default=camping.DEFAULT_REQUESTS_PER_SECOND,
+        help="Maximum number of requests per second sent to recreation.gov (default: %(default)s).",
+        type=positive_float,
     )
 
     args = parser.parse_args()
@@ -175,5 +225,6 @@ if __name__ == '__main__':
     if args.debug:
         logger.setLevel(logging.DEBUG)
 
-    parks = args.parks or [p.strip() for p in sys.stdin]
+    camping.RATE_LIMITER.rate = args.rps
+
     main()